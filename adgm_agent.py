@@ -1,11 +1,17 @@
 import os
+import asyncio
 import io
 import json
 import re
-import math
+import hashlib
+import functools
+import tempfile
+import threading
 import traceback
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor, as_completed
 from datetime import datetime
-from typing import List, Dict, Tuple, Optional
+from typing import List, Dict, Tuple, Optional, Iterable, Iterator, BinaryIO
 
 import streamlit as st
 import numpy as np
@@ -19,10 +25,30 @@ except Exception:
     genai = None
     GENAI_CLIENT_AVAILABLE = False
 
+try:
+    import hnswlib
+    HNSWLIB_AVAILABLE = True
+except Exception:
+    hnswlib = None
+    HNSWLIB_AVAILABLE = False
+
 EMBEDDING_MODEL = "models/embedding-001"
 RAG_MODEL = "models/gemini-2.5-flash"
 TOP_K = 3
 CHUNK_SIZE = 1000
+HEAD_CHARS = 8192
+EXCERPT_CHARS = 1500
+QUERY_CACHE_SIZE = 1024
+MAX_CONCURRENCY = 5
+EMBED_BATCH_SIZE = 64
+EMBED_WORKERS = 8
+EMBEDDING_DTYPE = np.float16
+SCORE_BLOCK_ROWS = 8192
+ANN_MIN_PASSAGES = 2000
+ANN_EF_SEARCH = 64
+INDEX_CACHE_DIR = os.path.join(os.path.expanduser("~"), ".cache", "adgm_agent", "index")
+GEN_CACHE_DIR = os.path.join(os.path.expanduser("~"), ".cache", "adgm_agent", "gen")
+GEN_CACHE_SIZE = 256
 
 CHECKLISTS = {
     "Company Incorporation": [
@@ -42,39 +68,66 @@ DOC_TYPE_KEYWORDS = {
     "Register of Members and Directors": ["register of members", "register of directors", "register of members and directors"],
 }
 
-def docx_to_text_and_docobj(docx_bytes: bytes) -> Tuple[str, Document]:
-    doc = Document(io.BytesIO(docx_bytes))
-    paragraphs = [p.text for p in doc.paragraphs if p.text and p.text.strip()]
-    return "\n\n".join(paragraphs), doc
+RED_FLAG_TRIGGERS = {
+    "jurisdiction": ["adgm", "abu dhabi global market"],
+    "signature": ["signature", "signed"],
+    "language": [" may "],
+}
 
-def chunk_text(text: str, size: int = CHUNK_SIZE) -> List[str]:
-    if not text:
-        return []
-    paragraphs = text.split("\n\n")
-    chunks = []
-    cur = []
-    cur_len = 0
+def _keyword_group(name: str, kws: List[str]) -> str:
+    return f"(?P<{name}>{'|'.join(re.escape(k) for k in sorted(kws, key=len, reverse=True))})"
+
+_DOCTYPE_GROUPS = {re.sub(r"\W+", "_", name).lower(): name for name in DOC_TYPE_KEYWORDS}
+_DOCTYPE_RE = re.compile(
+    "|".join(_keyword_group(g, DOC_TYPE_KEYWORDS[name]) for g, name in _DOCTYPE_GROUPS.items()),
+    re.IGNORECASE,
+)
+_RED_FLAG_RE = re.compile(
+    "|".join(_keyword_group(name, kws) for name, kws in RED_FLAG_TRIGGERS.items()),
+    re.IGNORECASE,
+)
+
+_JSON_RE = re.compile(r"\{.*\}", re.S)
+_MATCH_PHRASE_RE = re.compile(r"jurisdiction|governing law|signature", re.IGNORECASE)
+
+def iter_docx_paragraphs(doc: Document) -> Iterator[str]:
+    for p in doc.paragraphs:
+        if p.text and p.text.strip():
+            yield p.text
+
+def docx_to_paragraphs_and_docobj(fileobj: BinaryIO) -> Tuple[Iterator[str], Document]:
+    doc = Document(fileobj)
+    return iter_docx_paragraphs(doc), doc
+
+def head_text(paragraphs: Iterable[str], limit: int = HEAD_CHARS) -> str:
+    parts = []
+    total = 0
     for p in paragraphs:
-        pl = len(p)
-        if cur_len + pl > size and cur:
-            chunks.append("\n\n".join(cur))
-            cur = [p]
-            cur_len = pl
-        else:
-            cur.append(p)
-            cur_len += pl
-    if cur:
-        chunks.append("\n\n".join(cur))
-    return chunks
+        parts.append(p)
+        total += len(p) + 2
+        if total >= limit:
+            break
+    return "\n\n".join(parts)[:limit]
 
-def l2_norm(vec):
-    return math.sqrt(sum(x*x for x in vec))
+def find_match_phrases(paragraphs: Iterable[str]) -> set:
+    found = set()
+    for p in paragraphs:
+        found.update(m.group(0).lower() for m in _MATCH_PHRASE_RE.finditer(p))
+    return found
 
-def cosine_sim(a: List[float], b: List[float]) -> float:
-    denom = (l2_norm(a) * l2_norm(b))
-    if denom == 0:
-        return 0.0
-    return float(np.dot(np.array(a), np.array(b)) / denom)
+def chunk_text(paragraphs: Iterable[str], size: int = CHUNK_SIZE) -> List[str]:
+    paras = list(paragraphs)
+    if not paras:
+        return []
+    cum = np.cumsum(np.fromiter((len(p) for p in paras), dtype=np.int64, count=len(paras)))
+    chunks = []
+    start = 0
+    while start < len(paras):
+        base = cum[start - 1] if start else 0
+        end = max(int(np.searchsorted(cum, base + size, side="right")), start + 1)
+        chunks.append("\n\n".join(paras[start:end]))
+        start = end
+    return chunks
 
 def ensure_genai_ready() -> Tuple[bool, Optional[str]]:
     key = os.environ.get("GEMINI_API_KEY")
@@ -84,13 +137,27 @@ def ensure_genai_ready() -> Tuple[bool, Optional[str]]:
         return False, "google-genai is not installed."
     return True, None
 
+_CLIENT = None
+_CLIENT_LOCK = threading.Lock()
+
+def _client():
+    global _CLIENT
+    with _CLIENT_LOCK:
+        if _CLIENT is None:
+            _CLIENT = genai.Client(api_key=os.environ["GEMINI_API_KEY"])
+        return _CLIENT
+
+def _reset_client():
+    global _CLIENT
+    with _CLIENT_LOCK:
+        _CLIENT = None
+
 def embed_texts_genai(texts: List[str]) -> List[List[float]]:
     ok, msg = ensure_genai_ready()
     if not ok:
         raise RuntimeError(msg)
     try:
-        client = genai.Client(api_key=os.environ["GEMINI_API_KEY"])
-        resp = client.models.embed_content(model=EMBEDDING_MODEL, contents=texts)
+        resp = _client().models.embed_content(model=EMBEDDING_MODEL, contents=texts)
         if not hasattr(resp, "embeddings"):
             if isinstance(resp, dict) and "embeddings" in resp:
                 emb_list = resp["embeddings"]
@@ -106,74 +173,303 @@ def embed_texts_genai(texts: List[str]) -> List[List[float]]:
             vecs.append(list(vals))
         return vecs
     except Exception as e:
+        _reset_client()
         raise RuntimeError(f"Embedding call failed: {e}")
 
-def generate_with_genai(prompt: str) -> str:
+def parse_json_response(out: str) -> Dict:
+    try:
+        return json.loads(out)
+    except ValueError:
+        m = _JSON_RE.search(out)
+        return json.loads(m.group(0) if m else out)
+
+def parse_review_issues(out: str) -> List[Dict]:
+    parsed = parse_json_response(out)
+    if not isinstance(parsed, dict):
+        raise ValueError("Review response is not a JSON object.")
+    issues = parsed.get("issues")
+    if not isinstance(issues, list) or not all(isinstance(gi, dict) for gi in issues):
+        raise ValueError("Review response 'issues' is not a list of objects.")
+    return issues
+
+class _UncacheableResponse(Exception):
+    def __init__(self, text: str):
+        super().__init__("response not cacheable")
+        self.text = text
+
+def _is_cacheable(text: str, json_mode: bool) -> bool:
+    if not json_mode:
+        return True
+    try:
+        parse_review_issues(text)
+        return True
+    except ValueError:
+        return False
+
+def generate_with_genai(prompt: str, json_mode: bool = False) -> str:
+    h = hashlib.sha256(f"{RAG_MODEL}\0{int(json_mode)}\0{prompt}".encode("utf-8")).hexdigest()
+    try:
+        return _generate_cached(h, prompt, json_mode)
+    except _UncacheableResponse as e:
+        return e.text
+
+@functools.lru_cache(maxsize=GEN_CACHE_SIZE)
+def _generate_cached(prompt_hash: str, prompt: str, json_mode: bool) -> str:
+    path = os.path.join(GEN_CACHE_DIR, f"{prompt_hash}.txt")
+    try:
+        with open(path, "r", encoding="utf-8") as f:
+            text = f.read()
+        if _is_cacheable(text, json_mode):
+            return text
+        os.remove(path)
+    except OSError:
+        pass
+    text, from_model = _generate_uncached(prompt, json_mode)
+    if not from_model or not _is_cacheable(text, json_mode):
+        raise _UncacheableResponse(text)
+    tmp = None
+    try:
+        os.makedirs(GEN_CACHE_DIR, exist_ok=True)
+        fd, tmp = tempfile.mkstemp(dir=GEN_CACHE_DIR, suffix=".tmp")
+        with os.fdopen(fd, "w", encoding="utf-8") as f:
+            f.write(text)
+        os.replace(tmp, path)
+    except OSError:
+        if tmp and os.path.exists(tmp):
+            os.remove(tmp)
+    return text
+
+def _generate_uncached(prompt: str, json_mode: bool = False) -> Tuple[str, bool]:
     ok, msg = ensure_genai_ready()
     if not ok:
         raise RuntimeError(msg)
     try:
-        client = genai.Client(api_key=os.environ["GEMINI_API_KEY"])
-        resp = client.models.generate_content(model=RAG_MODEL, contents=prompt)
+        config = {"response_mime_type": "application/json"} if json_mode else None
+        resp = _client().models.generate_content(model=RAG_MODEL, contents=prompt, config=config)
         text = getattr(resp, "text", None)
         if text:
-            return text
+            return text, True
         if hasattr(resp, "candidates") and resp.candidates:
             candidate = resp.candidates[0]
             try:
-                return candidate.content.parts[0].text
+                return candidate.content.parts[0].text, True
             except Exception:
-                return str(candidate)
+                return str(candidate), False
         if isinstance(resp, dict) and "candidates" in resp and resp["candidates"]:
-            return json.dumps(resp["candidates"][0])
-        return str(resp)
+            return json.dumps(resp["candidates"][0]), False
+        return str(resp), False
     except Exception as e:
+        _reset_client()
         raise RuntimeError(f"Generation call failed: {e}")
 
+_QUERY_EMB_CACHE: "OrderedDict[str, Tuple[float, ...]]" = OrderedDict()
+_QUERY_EMB_LOCK = threading.Lock()
+
+def embed_queries_cached(queries: List[str]) -> List[Tuple[float, ...]]:
+    keys = [hashlib.sha256(q.encode("utf-8")).hexdigest() for q in queries]
+    found: Dict[str, Tuple[float, ...]] = {}
+    misses = {}
+    with _QUERY_EMB_LOCK:
+        for k, q in zip(keys, queries):
+            if k in found:
+                continue
+            if k in _QUERY_EMB_CACHE:
+                _QUERY_EMB_CACHE.move_to_end(k)
+                found[k] = _QUERY_EMB_CACHE[k]
+            else:
+                misses[k] = q
+    if misses:
+        vecs = embed_texts_genai(list(misses.values()))
+        if len(vecs) != len(misses):
+            raise RuntimeError("Embedding count mismatch")
+        with _QUERY_EMB_LOCK:
+            for k, v in zip(misses, vecs):
+                found[k] = _QUERY_EMB_CACHE[k] = tuple(v)
+            while len(_QUERY_EMB_CACHE) > QUERY_CACHE_SIZE:
+                _QUERY_EMB_CACHE.popitem(last=False)
+    return [found[k] for k in keys]
+
 class SimpleRagIndex:
     def __init__(self):
         self.passages: List[Dict] = []
+        self.matrix: Optional[np.ndarray] = None
+        self.embed_errors: List[str] = []
+        self.ann = None
 
-    def add_document(self, title: str, text: str, source: str = ""):
-        chunks = chunk_text(text)
+    def add_document(self, title: str, paragraphs: Iterable[str], source: str = ""):
+        chunks = chunk_text(paragraphs)
         for i, ch in enumerate(chunks):
-            self.passages.append({"id": f"{title}__{i}", "text": ch, "source": source, "embedding": None})
+            self.passages.append({"id": f"{title}__{i}", "text": ch, "source": source})
 
     def embed_all(self) -> None:
         texts = [p["text"] for p in self.passages]
         if not texts:
             return
-        vecs = embed_texts_genai(texts)
-        if len(vecs) != len(self.passages):
-            if len(vecs) == 1:
-                vecs = [vecs[0]] * len(self.passages)
-            else:
-                raise RuntimeError("Embedding count mismatch")
-        for p, v in zip(self.passages, vecs):
-            p["embedding"] = v
+        self.embed_errors = []
+        uniq: Dict[bytes, List[int]] = {}
+        for i, t in enumerate(texts):
+            uniq.setdefault(hashlib.sha1(t.encode("utf-8")).digest(), []).append(i)
+        buckets = list(uniq.values())
+        uniq_texts = [texts[b[0]] for b in buckets]
+        order = sorted(range(len(uniq_texts)), key=lambda j: len(uniq_texts[j]))
+        batches = [order[i:i + EMBED_BATCH_SIZE] for i in range(0, len(order), EMBED_BATCH_SIZE)]
+        vecs: List[Optional[List[float]]] = [None] * len(texts)
+        with ThreadPoolExecutor(max_workers=EMBED_WORKERS) as pool:
+            futures = {pool.submit(embed_texts_genai, [uniq_texts[j] for j in batch]): batch for batch in batches}
+            for fut in as_completed(futures):
+                batch = futures[fut]
+                try:
+                    batch_vecs = fut.result()
+                    if len(batch_vecs) != len(batch):
+                        if len(batch_vecs) == 1:
+                            batch_vecs = [batch_vecs[0]] * len(batch)
+                        else:
+                            raise RuntimeError("Embedding count mismatch")
+                except Exception as e:
+                    self.embed_errors.append(str(e))
+                    continue
+                for j, v in zip(batch, batch_vecs):
+                    for i in buckets[j]:
+                        vecs[i] = v
+        if all(v is None for v in vecs):
+            raise RuntimeError(self.embed_errors[0] if self.embed_errors else "No embeddings returned")
+        self.passages = [p for p, v in zip(self.passages, vecs) if v is not None]
+        vecs = [v for v in vecs if v is not None]
+        matrix = np.asarray(vecs, dtype=np.float32)
+        norms = np.linalg.norm(matrix, axis=1, keepdims=True)
+        norms[norms == 0] = 1.0
+        matrix /= norms
+        self.matrix = matrix.astype(EMBEDDING_DTYPE)
+        self._build_ann()
+
+    def _build_ann(self) -> None:
+        self.ann = None
+        if not HNSWLIB_AVAILABLE or self.matrix is None or self.matrix.shape[0] < ANN_MIN_PASSAGES:
+            return
+        n, dim = self.matrix.shape
+        ann = hnswlib.Index(space="cosine", dim=dim)
+        ann.init_index(max_elements=n, ef_construction=200, M=16)
+        ann.add_items(np.asarray(self.matrix, dtype=np.float32), np.arange(n))
+        self.ann = ann
+
+    @staticmethod
+    def cache_path(ref_files: List[BinaryIO]) -> str:
+        h = hashlib.sha256(f"{EMBEDDING_MODEL}|{CHUNK_SIZE}".encode("utf-8"))
+        for f in ref_files:
+            fh = hashlib.sha256()
+            f.seek(0)
+            for block in iter(lambda: f.read(1 << 20), b""):
+                fh.update(block)
+            f.seek(0)
+            h.update(f.name.encode("utf-8") + b"\0")
+            h.update(fh.digest())
+        return os.path.join(INDEX_CACHE_DIR, h.hexdigest())
+
+    @staticmethod
+    def is_cached(path: str) -> bool:
+        return os.path.exists(path + ".npy") and os.path.exists(path + ".json")
+
+    def save(self, path: str) -> None:
+        if self.matrix is None:
+            raise RuntimeError("Index has no embeddings to save.")
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        with open(path + ".json.tmp", "w", encoding="utf-8") as f:
+            json.dump(self.passages, f)
+        with open(path + ".npy.tmp", "wb") as f:
+            np.save(f, np.ascontiguousarray(self.matrix, dtype=EMBEDDING_DTYPE))
+        os.replace(path + ".json.tmp", path + ".json")
+        os.replace(path + ".npy.tmp", path + ".npy")
+        self._save_ann(path)
+
+    def _save_ann(self, path: str) -> None:
+        if self.ann is None:
+            return
+        fd, tmp = tempfile.mkstemp(dir=os.path.dirname(path), suffix=".hnsw.tmp")
+        os.close(fd)
+        try:
+            self.ann.save_index(tmp)
+            os.replace(tmp, path + ".hnsw")
+        except Exception:
+            if os.path.exists(tmp):
+                os.remove(tmp)
+            raise
+
+    def _load_ann(self, path: str) -> bool:
+        self.ann = None
+        if not HNSWLIB_AVAILABLE or self.matrix.shape[0] < ANN_MIN_PASSAGES or not os.path.exists(path + ".hnsw"):
+            return False
+        n, dim = self.matrix.shape
+        ann = hnswlib.Index(space="cosine", dim=dim)
+        try:
+            ann.load_index(path + ".hnsw", max_elements=n)
+        except Exception:
+            return False
+        if ann.get_current_count() != n:
+            return False
+        self.ann = ann
+        return True
+
+    def load(self, path: str) -> None:
+        with open(path + ".json", "r", encoding="utf-8") as f:
+            passages = json.load(f)
+        matrix = np.load(path + ".npy", mmap_mode="r")
+        if matrix.ndim != 2 or matrix.shape[0] != len(passages):
+            raise RuntimeError("Cached index is inconsistent.")
+        self.passages = passages
+        self.matrix = matrix
+        if not self._load_ann(path):
+            self._build_ann()
+            try:
+                self._save_ann(path)
+            except Exception:
+                pass
+
+    def _scores(self, q: np.ndarray) -> np.ndarray:
+        n = self.matrix.shape[0]
+        sims = np.empty((q.shape[0], n), dtype=np.float32)
+        for start in range(0, n, SCORE_BLOCK_ROWS):
+            block = np.asarray(self.matrix[start:start + SCORE_BLOCK_ROWS], dtype=np.float32)
+            sims[:, start:start + block.shape[0]] = q @ block.T
+        return sims
 
     def retrieve(self, query: str, top_k: int = TOP_K) -> List[Dict]:
-        if not self.passages or any(p.get("embedding") is None for p in self.passages):
+        return self.retrieve_batch([query], top_k=top_k)[0]
+
+    def retrieve_batch(self, queries: List[str], top_k: int = TOP_K) -> List[List[Dict]]:
+        if not queries:
             return []
-        qvec = embed_texts_genai([query])[0]
-        sims = [(cosine_sim(qvec, p["embedding"]), p) for p in self.passages]
-        sims_sorted = sorted(sims, key=lambda x: x[0], reverse=True)
-        return [p for score, p in sims_sorted[:top_k]]
+        if not self.passages or self.matrix is None:
+            return [[] for _ in queries]
+        q = np.asarray(embed_queries_cached(queries), dtype=np.float32)
+        qn = np.linalg.norm(q, axis=1, keepdims=True)
+        valid = qn[:, 0] > 0
+        qn[~valid] = 1.0
+        q /= qn
+        if self.ann is not None:
+            k = min(top_k, len(self.passages))
+            self.ann.set_ef(max(ANN_EF_SEARCH, k))
+            labels, _ = self.ann.knn_query(q, k=k)
+            return [[self.passages[i] for i in row] if ok else [] for row, ok in zip(labels, valid)]
+        sims = self._scores(q)
+        k = min(top_k, sims.shape[1])
+        if k <= 0:
+            return [[] for _ in queries]
+        top = np.argpartition(-sims, k - 1, axis=1)[:, :k]
+        order = np.take_along_axis(top, np.argsort(-np.take_along_axis(sims, top, axis=1), axis=1), axis=1)
+        return [[self.passages[i] for i in row] if ok else [] for row, ok in zip(order, valid)]
 
 def detect_document_types(text: str) -> List[str]:
-    found = set()
-    t = text.lower()
-    for docname, kws in DOC_TYPE_KEYWORDS.items():
-        for kw in kws:
-            if kw in t:
-                found.add(docname)
-                break
+    found = {_DOCTYPE_GROUPS[m.lastgroup] for m in _DOCTYPE_RE.finditer(text)}
     return list(found) if found else ["Unknown Document Type"]
 
-def check_for_red_flags(text: str) -> List[Dict]:
+def check_for_red_flags(paragraphs: Iterable[str]) -> List[Dict]:
     issues = []
-    t = text.lower()
-    if "adgm" not in t and "abu dhabi global market" not in t:
+    seen = set()
+    for p in paragraphs:
+        seen.update(m.lastgroup for m in _RED_FLAG_RE.finditer(p))
+        if len(seen) == len(RED_FLAG_TRIGGERS):
+            break
+    if "jurisdiction" not in seen:
         issues.append({
             "section": "jurisdiction",
             "issue": "Jurisdiction clause does not specify ADGM",
@@ -181,7 +477,7 @@ def check_for_red_flags(text: str) -> List[Dict]:
             "suggestion": "Update jurisdiction to 'Abu Dhabi Global Market (ADGM)'.",
             "citation": None
         })
-    if not any(s in t for s in ["signature", "signed", "signature:"]):
+    if "signature" not in seen:
         issues.append({
             "section": "signature",
             "issue": "No signature block detected",
@@ -189,7 +485,7 @@ def check_for_red_flags(text: str) -> List[Dict]:
             "suggestion": "Add a signatory section with name, capacity, and date.",
             "citation": None
         })
-    if " may " in t:
+    if "language" in seen:
         issues.append({
             "section": "language",
             "issue": "Ambiguous use of 'may' detected; could be non-binding",
@@ -200,31 +496,92 @@ def check_for_red_flags(text: str) -> List[Dict]:
     return issues
 
 def merge_issues(rule: List[Dict], ai: List[Dict]) -> List[Dict]:
-    out = []
-    seen = set()
+    by_key: Dict[Tuple[str, str], Dict] = {}
     for it in (rule + ai):
         key = (it.get("section",""), (it.get("issue","") or "").strip().lower())
-        if key in seen:
-            for ex in out:
-                ek = (ex.get("section",""), (ex.get("issue","") or "").strip().lower())
-                if ek == key:
-                    if it.get("citation") and not ex.get("citation"):
-                        ex["citation"] = it.get("citation")
-                    break
-        else:
-            seen.add(key)
-            out.append(it.copy())
-    return out
-
-def add_inline_comment_to_doc(doc: Document, paragraph_match: str, comment_text: str):
-    lowered = paragraph_match.lower()
-    for para in doc.paragraphs:
-        if lowered in (para.text or "").lower():
-            run = para.add_run(" ")
-            run.add_text("")
-            review_run = para.add_run(f"[REVIEW: {comment_text}]")
-            review_run.font.color.rgb = RGBColor(0xB2, 0x00, 0x00)
-            review_run.bold = True
+        existing = by_key.get(key)
+        if existing is None:
+            by_key[key] = it.copy()
+        elif it.get("citation") and not existing.get("citation"):
+            existing["citation"] = it.get("citation")
+    return list(by_key.values())
+
+def add_inline_comments(doc: Document, items: List[Tuple[str, str]]):
+    if not items:
+        return
+    paras_lower = [(p, (p.text or "").lower()) for p in doc.paragraphs]
+    for paragraph_match, comment_text in items:
+        lowered = paragraph_match.lower()
+        for para, para_lower in paras_lower:
+            if lowered in para_lower:
+                run = para.add_run(" ")
+                run.add_text("")
+                review_run = para.add_run(f"[REVIEW: {comment_text}]")
+                review_run.font.color.rgb = RGBColor(0xB2, 0x00, 0x00)
+                review_run.bold = True
+
+async def analyze_one(name: str, head: str, doc_obj: Document, excerpt: str, passages: List[Dict]) -> Dict:
+    logs = []
+    rag_failed = False
+    rule_issues = check_for_red_flags(iter_docx_paragraphs(doc_obj))
+    ai_issues = []
+    if passages:
+        try:
+            ctx = ""
+            for i, p in enumerate(passages, start=1):
+                ctx += f"[Passage {i} | Source: {p.get('source','')}]\\n{p['text']}\\n\\n"
+            prompt = (
+                "You are an ADGM compliance reviewer. Using ONLY the ADGM passages in CONTEXT, "
+                "analyze the DOCUMENT excerpt and return STRICT JSON with a single key 'issues'.\n\n"
+                f"CONTEXT:\n{ctx}\n\nDOCUMENT_EXCERPT:\n{excerpt}\n\n"
+                "Return only valid JSON."
+            )
+            out = await asyncio.to_thread(generate_with_genai, prompt, True)
+            for gi in parse_review_issues(out):
+                ai_issues.append({
+                    "section": gi.get("section","(from AI)"),
+                    "issue": gi.get("issue",""),
+                    "severity": gi.get("severity","Medium"),
+                    "suggestion": gi.get("suggestion",""),
+                    "citation": gi.get("citation")
+                })
+        except Exception as e:
+            rag_failed = True
+            logs.append(f"RAG step failed for {name}: {e}")
+            logs.extend(traceback.format_exc().splitlines()[:6])
+    merged = merge_issues(rule_issues, ai_issues)
+    phrases = find_match_phrases(iter_docx_paragraphs(doc_obj)) if merged else set()
+    comments = []
+    for it in merged:
+        match_phrase = ""
+        if "juris" in (it.get("section","") or "").lower():
+            if "jurisdiction" in phrases:
+                match_phrase = "jurisdiction"
+            elif "governing law" in phrases:
+                match_phrase = "governing law"
+        if not match_phrase and "signatur" in (it.get("section","") or "").lower():
+            if "signature" in phrases:
+                match_phrase = "signature"
+        if not match_phrase and "may" in it.get("issue","").lower():
+            match_phrase = "may"
+        if not match_phrase:
+            match_phrase = (head[:80].split("\n\n")[0])[:40]
+        comments.append((match_phrase, f"{it.get('issue')} | Suggestion: {it.get('suggestion')}"))
+    add_inline_comments(doc_obj, comments)
+    for it in merged:
+        it["document"] = name
+    outb = io.BytesIO()
+    await asyncio.to_thread(doc_obj.save, outb)
+    return {"issues": merged, "bytes": outb.getvalue(), "log": logs, "rag_failed": rag_failed}
+
+async def analyze_files(jobs: List[Tuple]) -> List[Dict]:
+    sem = asyncio.Semaphore(MAX_CONCURRENCY)
+
+    async def bounded(job):
+        async with sem:
+            return await analyze_one(*job)
+
+    return await asyncio.gather(*[bounded(job) for job in jobs])
 
 st.set_page_config(page_title="ADGM Corporate Agent", layout="centered")
 st.title("ADGM Corporate Agent — RAG + Rule-based Demo")
@@ -259,25 +616,46 @@ if build_btn:
         log("Build requested but no reference files.")
     else:
         log(f"Indexing {len(ref_files)} reference files...")
-        for rf in ref_files:
-            raw = rf.read()
+        cache_path = SimpleRagIndex.cache_path(ref_files)
+        index = st.session_state["rag_index"]
+        loaded = False
+        if SimpleRagIndex.is_cached(cache_path):
             try:
-                text, _ = docx_to_text_and_docobj(raw)
-            except Exception:
-                text = raw.decode("utf-8", errors="ignore")
-            st.session_state["rag_index"].add_document(rf.name, text, source=rf.name)
-        try:
-            log("Creating embeddings...")
-            st.session_state["rag_index"].embed_all()
-            st.session_state["index_built"] = True
-            st.success("RAG index built.")
-        except Exception as e:
-            st.session_state["index_built"] = False
-            st.error("Failed to create embeddings.")
-            log(f"Embedding error: {e}")
-            tb = traceback.format_exc().splitlines()[:6]
-            for line in tb:
-                log(line)
+                index.load(cache_path)
+                loaded = True
+                st.session_state["index_built"] = True
+                log(f"Loaded cached index ({len(index.passages)} passages).")
+                st.success("RAG index loaded from cache.")
+            except Exception as e:
+                index = st.session_state["rag_index"] = SimpleRagIndex()
+                log(f"Cached index unreadable, rebuilding: {e}")
+        if not loaded:
+            for rf in ref_files:
+                try:
+                    paragraphs, _ = docx_to_paragraphs_and_docobj(rf)
+                except Exception:
+                    rf.seek(0)
+                    paragraphs = rf.read().decode("utf-8", errors="ignore").split("\n\n")
+                index.add_document(rf.name, paragraphs, source=rf.name)
+            try:
+                log("Creating embeddings...")
+                index.embed_all()
+                for err in index.embed_errors:
+                    log(f"Embedding batch skipped: {err}")
+                st.session_state["index_built"] = True
+                st.success("RAG index built.")
+                if not index.embed_errors:
+                    try:
+                        index.save(cache_path)
+                    except Exception as e:
+                        log(f"Could not cache index: {e}")
+            except Exception as e:
+                st.session_state["index_built"] = False
+                st.error("Failed to create embeddings.")
+                log(f"Embedding error: {e}")
+                tb = traceback.format_exc().splitlines()[:6]
+                for line in tb:
+                    log(line)
 
 if user_files:
     st.info(f"Analyzing {len(user_files)} file(s)...")
@@ -291,70 +669,37 @@ if user_files:
     }
     reviewed_outputs = []
     all_detected = []
+    parsed_files = []
     for uf in user_files:
-        raw = uf.read()
-        text, doc_obj = docx_to_text_and_docobj(raw)
-        detected = detect_document_types(text)
+        uf.seek(0)
+        paragraphs, doc_obj = docx_to_paragraphs_and_docobj(uf)
+        head = head_text(paragraphs)
+        detected = detect_document_types(head)
         all_detected.append({"filename": uf.name, "detected": detected})
         log(f"Detected for {uf.name}: {detected}")
-        rule_issues = check_for_red_flags(text)
-        ai_issues = []
-        if st.session_state.get("index_built", False):
-            try:
-                excerpt = text[:1500] if len(text) > 1500 else text
-                passages = st.session_state["rag_index"].retrieve(excerpt, top_k=TOP_K)
-                if passages:
-                    ctx = ""
-                    for i, p in enumerate(passages, start=1):
-                        ctx += f"[Passage {i} | Source: {p.get('source','')}]\\n{p['text']}\\n\\n"
-                    prompt = (
-                        "You are an ADGM compliance reviewer. Using ONLY the ADGM passages in CONTEXT, "
-                        "analyze the DOCUMENT excerpt and return STRICT JSON with a single key 'issues'.\n\n"
-                        f"CONTEXT:\n{ctx}\n\nDOCUMENT_EXCERPT:\n{excerpt}\n\n"
-                        "Return only valid JSON."
-                    )
-                    out = generate_with_genai(prompt)
-                    m = re.search(r"\{.*\}$", out, re.S)
-                    json_text = m.group(0) if m else out
-                    parsed = json.loads(json_text)
-                    for gi in parsed.get("issues", []):
-                        ai_issues.append({
-                            "section": gi.get("section","(from AI)"),
-                            "issue": gi.get("issue",""),
-                            "severity": gi.get("severity","Medium"),
-                            "suggestion": gi.get("suggestion",""),
-                            "citation": gi.get("citation")
-                        })
-            except Exception as e:
-                log(f"RAG step failed for {uf.name}: {e}")
-                tb = traceback.format_exc().splitlines()[:6]
-                for line in tb:
-                    log(line)
-                st.warning(f"RAG step failed for {uf.name}, rule-based only.")
-        merged = merge_issues(rule_issues, ai_issues)
-        for it in merged:
-            match_phrase = ""
-            if "juris" in (it.get("section","") or "").lower():
-                if "jurisdiction" in text.lower():
-                    match_phrase = "jurisdiction"
-                elif "governing law" in text.lower():
-                    match_phrase = "governing law"
-            if not match_phrase and "signatur" in (it.get("section","") or "").lower():
-                if "signature" in text.lower():
-                    match_phrase = "signature"
-            if not match_phrase and "may" in it.get("issue","").lower():
-                match_phrase = "may"
-            if not match_phrase:
-                match_phrase = (text[:80].split("\n\n")[0])[:40]
-            comment_text = f"{it.get('issue')} | Suggestion: {it.get('suggestion')}"
-            add_inline_comment_to_doc(doc_obj, match_phrase, comment_text)
-        for it in merged:
-            it["document"] = uf.name
-        report["issues_found"].extend(merged)
-        outb = io.BytesIO()
-        doc_obj.save(outb)
-        outb.seek(0)
-        reviewed_outputs.append({"filename": f"reviewed_{uf.name}", "bytes": outb.read()})
+        excerpt = head[:EXCERPT_CHARS]
+        parsed_files.append((uf, head, doc_obj, excerpt))
+    retrieved = [[] for _ in parsed_files]
+    if st.session_state.get("index_built", False):
+        try:
+            retrieved = st.session_state["rag_index"].retrieve_batch([f[3] for f in parsed_files], top_k=TOP_K)
+        except Exception as e:
+            log(f"Retrieval failed: {e}")
+            tb = traceback.format_exc().splitlines()[:6]
+            for line in tb:
+                log(line)
+            st.warning("RAG retrieval failed, rule-based only.")
+    use_rag = st.session_state.get("index_built", False)
+    jobs = [(uf.name, head, doc_obj, excerpt, passages if use_rag else [])
+            for (uf, head, doc_obj, excerpt), passages in zip(parsed_files, retrieved)]
+    results = asyncio.run(analyze_files(jobs))
+    for (uf, _, _, _), res in zip(parsed_files, results):
+        for line in res["log"]:
+            log(line)
+        if res["rag_failed"]:
+            st.warning(f"RAG step failed for {uf.name}, rule-based only.")
+        report["issues_found"].extend(res["issues"])
+        reviewed_outputs.append({"filename": f"reviewed_{uf.name}", "bytes": res["bytes"]})
     types_present = {t for f in all_detected for t in f['detected']}
     if any(x in types_present for x in CHECKLISTS["Company Incorporation"]):
         report["process"] = "Company Incorporation"